@@ -3,7 +3,6 @@ import configparser
 from email.policy import default
 import glob
 import os
-import random
 import shutil
 import string
 import sys
@@ -12,6 +11,7 @@ import textwrap
 from collections import defaultdict
 from datetime import date
 from pathlib import Path
+from random import choices
 
 import pandas as pd
 from Bio import SeqIO
@@ -106,22 +106,19 @@ def collect_seqs(gene):
 
 def id_generator(size=5, chars=string.digits):
     """"Generate random number with 5 digits."""
-    return ''.join(random.choice(chars) for _ in range(size))
+    return ''.join(choices(chars, k=size))
 
 
 def paralog_name(abbrev, keys):
     """"Prepare paralog name (short name + 5 random digits).
-    Recursive function.
     example: Homosap..12345
     input: short name of an organism, names of already existing paralogs
-    for a given organism
+    for a given organism (set or dict keys)
     return: unique paralog name"""
-    id_ = id_generator()
-    pname = f'{abbrev}..p{id_}'
-    if pname not in keys:
-        return pname
-    else:
-        paralog_name(abbrev, keys)
+    while True:
+        pname = f'{abbrev}..p{id_generator()}'
+        if pname not in keys:
+            return pname
 
 
 def parse_table(table):
@@ -1,43 +1,47 @@
 #!/usr/bin/env python
 import configparser
+import csv
+import multiprocessing
 import os
 import subprocess
 import sys
 import textwrap
-import warnings
 from collections import defaultdict
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import islice
 from multiprocessing import Pool
 from pathlib import Path
 from shutil import copyfile, rmtree
 
-from Bio import BiopythonExperimentalWarning
-from Bio import SeqIO
+import numpy as np
+import pandas as pd
 from ete3 import Tree
 
 from phylofisher import help_formatter
 
-with warnings.catch_warnings():
-    warnings.simplefilter('ignore', BiopythonExperimentalWarning)
-    from Bio import SearchIO
 
-def run_bash(cmd):
+def run_bash(cmd, stdout=subprocess.PIPE, input_=None):
     '''
     Runs bash command. Prints error if command fails.
+    A command given as a list is executed directly, without a shell.
 
     :param cmd: command to run
-    :type cmd: str
+    :type cmd: str or list
+    :param stdout: where to send stdout (captured by default)
+    :param input_: bytes sent to stdin
+    :return: captured stdout
     '''
-    p = subprocess.run(cmd, shell=True, capture_output=True) #, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    p = subprocess.run(cmd, shell=isinstance(cmd, str), stdout=stdout, stderr=subprocess.PIPE, input=input_)
     if p.returncode != 0:
         # Print failing command
         print('Command:')
-        print(cmd)  
+        print(cmd if isinstance(cmd, str) else ' '.join(cmd))
         print(2*'\n')
 
         # Print std out
         print('stdout:')
-        print(p.stdout.decode())
+        print(p.stdout.decode() if p.stdout else '')
         print(2*'\n')
 
         # Print std err
@@ -46,6 +50,42 @@ def run_bash(cmd):
         
         # Exit fisher.py
         sys.exit(1)
+    return p.stdout
+
+
+def fasta_records(lines):
+    """Parses fasta lines without building SeqRecord objects.
+
+    returns: generator of (name, seq) tuples, where name is the first
+    word of a header"""
+    name = None
+    seq = []
+    for line_ in lines:
+        if line_.startswith('>'):
+            if name is not None:
+                yield name, ''.join(seq)
+            title = line_[1:].split(maxsplit=1)
+            name = title[0] if title else ''
+            seq = []
+        elif name is not None:
+            seq.append(line_.strip())
+    if name is not None:
+        yield name, ''.join(seq)
+
+
+def parse_fasta(fasta):
+    """Parses fasta file, see fasta_records."""
+    with open(fasta) as infile:
+        yield from fasta_records(infile)
+
+
+@lru_cache(maxsize=None)
+def load_orthologs(gene):
+    """Parses orthologs of a gene from the database. Cached, so every
+    gene is parsed only once for all samples.
+
+    returns: dict {org: seq}"""
+    return dict(parse_fasta(str(Path(dfo, f'orthologs/{gene}.fas'))))
 
 
 class Hit:
@@ -63,21 +103,22 @@ class Hit:
                 which mean corresponding and non_corresponding best blast hit
                 example: q1r means best blast/hmmer hit (depends on path_)
                         which is also reciprocal best blast hit to query
-                        gene in our database"""
+                        gene in our database
+    - in_hmm: True if hit is also in hmmer hits (hmm_hits set)"""
+
+    __slots__ = ('name', 'seq', 'query', 'path_', 'quality', 'in_hmm')
 
     def __init__(self, name, seq, query, hmm_hits):
         self.name = name
         self.seq = seq
         self.query = query
-        self.hmm_hits = hmm_hits
         self.path_ = ""
         self.quality = ""
+        self.in_hmm = name in hmm_hits
 
     def in_hmm_hits(self):
         """Controls if hit in also in hmmer hits"""
-        if self.name in self.hmm_hits:
-            return True
-        return False
+        return self.in_hmm
 
 
 class Query:
@@ -87,17 +128,17 @@ class Query:
     - query: refers to a gene
     - squery: always False, not a sprcific query (fix it)"""
 
-    def __init__(self, query, hmm_hits, infile_proteins):
+    def __init__(self, query, hmm_hits):
         self.query = query
         self.hmm_hits = hmm_hits
-        self.infile_proteins = infile_proteins
+        self.hmm_hits_set = set(hmm_hits)
         self.squery = False
 
     def hits(self):
         """parse all hmmerhits as Hit objets
         result is a generator producing one hit at a time"""
         for hit in self.hmm_hits:
-            hit = Hit(hit, self.infile_proteins[hit], self.query, self.hmm_hits)
+            hit = Hit(hit, sample_proteins[hit], self.query, self.hmm_hits_set)
             hit.path_ = "HMM"
             yield hit
 
@@ -110,11 +151,12 @@ class SpecQuery:
     - organisms: organisms from which blast queries should be selected.
     """
 
-    def __init__(self, query, spec_queries, hmm_hits, infile_proteins):
+    def __init__(self, query, spec_queries, hmm_hits):
         self.query = query
         self.hmm_hits = hmm_hits
+        self.hmm_hits_set = set(hmm_hits)
         self.seqs = []
-        self.infile_proteins = infile_proteins
+        self.blast_hits = None
         self.organisms = [org.strip(' "\'') for org in spec_queries.split(',')]
 
     def get_specific_query(self):
@@ -125,101 +167,124 @@ class SpecQuery:
          and set seed sequences for blast as self.seqs
         if gene is present in self.organisms or None"""
         at_least_one = False
-        gene_dict = {}
-        for record in SeqIO.parse(str(Path(dfo, f'orthologs/{self.query}.fas')), 'fasta'):
-            gene_dict[record.name] = str(record.seq)
+        gene_dict = load_orthologs(self.query)
         for org in self.organisms:
             if org in gene_dict:
                 self.seqs.append(gene_dict[org])
                 at_least_one = True
         return at_least_one
 
-    def spec_query_blast(self):
-        """Blast against sample with sequence selected according to spec queries.
-        Returns: list with ordered best blast hits."""
-        db = f'{args.output}/tmp/{sample_name}/{os.path.basename(infile)}.blastdb'
-        qfile = f'{args.output}/tmp/{sample_name}/{self.query}_collected.fas'
-        bout = f'{args.output}/tmp/{sample_name}/{self.query}.blastout'
-        with open(qfile, 'w') as f:
-            n = 0  # just for uniq names of spec query sequences
-            for query_sequence in self.seqs:
-                f.write(f'>{n}\n{query_sequence.replace("-", "")}\n')
-
-        cmd = f'blastp -evalue 1e-10 -query {qfile} -db {db} -out {bout} -outfmt "6 qseqid sseqid evalue"'
-        run_bash(cmd)
-        blast_hits = []
-        for line_ in open(bout):
-            prot_name = line_.split('\t')[1]
-            if prot_name not in blast_hits:
-                blast_hits.append(prot_name)
-        return blast_hits
-
     def hits(self):
         """Generator function which return Hit objects prioritized by blast search
         when some specific query is present or prioritized by hmmsearch"""
-        spec_query = self.get_specific_query()
-        if spec_query:
-            blast_hits = self.spec_query_blast()
-            if not blast_hits:
-                return None
-            for blast_hit in blast_hits:
-                hit = Hit(blast_hit, self.infile_proteins[blast_hit], self.query, self.hmm_hits)
+        if self.blast_hits is not None:
+            for blast_hit in self.blast_hits:
+                hit = Hit(blast_hit, sample_proteins[blast_hit], self.query, self.hmm_hits_set)
                 hit.path_ += "SBH"
                 yield hit
         else:
             for hmm_hit in self.hmm_hits:
-                hit = Hit(hmm_hit, self.infile_proteins[hmm_hit], self.query, self.hmm_hits)
+                hit = Hit(hmm_hit, sample_proteins[hmm_hit], self.query, self.hmm_hits_set)
                 hit.path_ += "HMM"
                 yield hit
 
+
+def batch_spec_query_blast(spec_query_objs, sample_name):
+    """Blast (diamond) against sample with sequences selected according
+    to spec queries of all genes at once. Sets ordered best blast hits as
+    blast_hits of every SpecQuery which has at least one seed sequence."""
+    qfile = f'{args.output}/tmp/{sample_name}/spec_queries.fas'
+    db = f'{args.output}/tmp/{sample_name}/sample.dmnd'
+    bout = f'{args.output}/tmp/{sample_name}/spec.res'
+    with_seeds = []
+    with open(qfile, 'w') as f:
+        for spec_query in spec_query_objs:
+            if spec_query.get_specific_query():
+                with_seeds.append(spec_query)
+                # n just for uniq names of spec query sequences
+                for n, query_sequence in enumerate(spec_query.seqs):
+                    f.write(f'>{spec_query.query}@{n}\n{query_sequence.replace("-", "")}\n')
+    if not with_seeds:
+        return
+
+    cmd = (f'diamond blastp -e 1e-10 --more-sensitive -k 500 -q {qfile} -d {db} -o {bout} '
+           f'-p {args.threads} --outfmt 6 qseqid sseqid evalue')
+    run_bash(cmd)
+    blast_hits = defaultdict(list)
+    seen = set()
+    for line_ in open(bout):
+        qseqid, prot_name, _ = line_.split('\t', 2)
+        gene = qseqid.rsplit('@', 1)[0]
+        if (gene, prot_name) not in seen:
+            seen.add((gene, prot_name))
+            blast_hits[gene].append(prot_name)
+    for spec_query in with_seeds:
+        spec_query.blast_hits = blast_hits.get(spec_query.query, [])
+
+
 def length_check(trimmed_aln):
     """Returns set of names of sequenes which have meaningful part
-    (without X or -) longer than 30% of trimmed alignment."""
+    (without X or -) longer than 30% of trimmed alignment.
+
+    trimmed_aln: trimmed alignment in fasta format as a string"""
+    names, seqs = [], []
+    for name, seq in fasta_records(trimmed_aln.splitlines()):
+        if '@' in name:
+            names.append(name)
+            seqs.append(seq)
+    # all sequences are scanned at once as one byte buffer
+    arr = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    ends = np.cumsum(lengths)
+    # 45 is '-', 88 is 'X'
+    meaningful = np.concatenate(([0], np.cumsum((arr != 45) & (arr != 88))))
+    true_lengths = meaningful[ends] - meaningful[ends - lengths]
+    ratios = np.divide(true_lengths, lengths, out=np.zeros(len(seqs)), where=lengths > 0)
     correct_length = {}
-    for record in SeqIO.parse(trimmed_aln, 'fasta'):
-        if '@' in record.name:
-            true_length = len(str(record.seq).replace('-', '').replace('X', ''))
-            if true_length / len(record.seq) > 0.3:
-                correct_length[record.name] = round((true_length / len(record.seq)), 2)
+    for name, ratio in zip(names, ratios):
+        if ratio > 0.3:
+            correct_length[name] = round(float(ratio), 2)
     return correct_length
 
 
-def makeblastdb():
-    """Prepares blast database from sample input file"""
-    cmd = f"makeblastdb -in {infile} -out {args.output}/tmp/{sample_name}/{os.path.basename(infile)}.blastdb -dbtype prot"
+def makediamonddb(infile, sample_name):
+    """Prepares diamond database from sample input file"""
+    cmd = f"diamond makedb --in {infile} -d {args.output}/tmp/{sample_name}/sample.dmnd"
     run_bash(cmd)
 
 
-def hmmer(query):
-    """Performs hmmsearch with a given gene.
+def hmmer(threads, infile, sample_name):
+    """Performs a single hmmsearch of all genes (concatenated profiles)
+    against the sample.
 
-    returns: tuple with (gene_name, list of hmm hits [hmm1, hmm2 ... hmmn]"""
-    hmm_prof = str(Path(dfo, f'profiles/{query}.hmm'))
-    cmd = f'hmmsearch -E 1e-10 {hmm_prof} {infile} > {args.output}/tmp/{sample_name}/{query}.hmmout'
+    returns: dict {gene: list of hmm hits [hmm1, hmm2 ... hmmn]}"""
+    tblout = f'{args.output}/tmp/{sample_name}/hmmsearch.tbl'
+    cmd = f'hmmsearch -o /dev/null --noali --cpu {threads} -E 1e-10 --tblout {tblout} {hmm_db} {infile}'
     run_bash(cmd)
-    hits = []
-    for hit in SearchIO.read(f'{args.output}/tmp/{sample_name}/{query}.hmmout', 'hmmer3-text'):
-        hits.append(hit.id)
-    return query, hits
+    hits = defaultdict(list)
+    for line_ in open(tblout):
+        if not line_.startswith('#'):
+            sline = line_.split()
+            # hits are ordered by e-value within every query
+            hits[hmm_names[sline[2]]].append(sline[0])
+    return hits
 
 
-def get_gene_dict(threads, infile_proteins, spec_queries=None):
+def get_gene_dict(threads, infile, sample_name, spec_queries=None):
     """This function prepare SpeqQeury or Query for all genes.
     Query type depends if spec_queries are specified in input metadata
     for a given organism."""
     gene_dict = {}
-    with Pool(processes=threads) as pool:
-        hmm_pool = list(pool.map(hmmer, profiles))
-
-        for query, hmm_hits in hmm_pool:
-            if hmm_hits:
-                if spec_queries:
-                    gene_dict[query] = SpecQuery(
-                        query, spec_queries, hmm_hits, infile_proteins)
-                else:
-                    gene_dict[query] = Query(query, hmm_hits, infile_proteins)
+    hmm_pool = hmmer(threads, infile, sample_name)
+    for query in profiles:
+        hmm_hits = hmm_pool.get(query)
+        if hmm_hits:
+            if spec_queries:
+                gene_dict[query] = SpecQuery(query, spec_queries, hmm_hits)
             else:
-                print(f"{query} exluded. No hmm hits.")
+                gene_dict[query] = Query(query, hmm_hits)
+        else:
+            print(f"{query} exluded. No hmm hits.")
     return gene_dict
 
 
@@ -228,17 +293,11 @@ def best_hits(max_hits, gene):
     Candidates have to be in hmm_hits
 
     returns: tuple with gene name and list with candidates names"""
-    candidates = []
-    hits = gene.hits()
-    counter = 0
-    if hits:
-        for hit in hits:
-            if counter == max_hits:
-                break
-            counter += 1
-            if hit.in_hmm_hits() is True:
-                candidates.append(hit)
-    return gene.query, candidates
+    hits = islice(gene.hits(), max_hits)
+    if isinstance(gene, Query):
+        # Query hits are hmm hits by definition
+        return gene.query, list(hits)
+    return gene.query, [hit for hit in hits if hit.in_hmm_hits()]
 
 
 def bac_gog_db():
@@ -247,41 +306,85 @@ def bac_gog_db():
     returns tuple with ls of [bacterial names] and {gene: orthogtoup/df} dir"""
     bac = set()
     for line_ in open(str(Path(dfo, 'orthomcl/bacterial'))):
-        bac.add(line_[:-1])
+        bac.add(line_.rstrip('\n'))
     g_og = {}
     for line_ in open(str(Path(dfo, 'orthomcl/gene_og'))):
-        sline = line_.split('\t')
-        g_og[sline[0]] = sline[1]
+        gene, ogs = line_.rstrip('\n').split('\t', 1)
+        # comma separated orthogroups (build_database.py)
+        g_og[gene] = frozenset(ogs.split(','))
     return bac, g_og
 
 
-def get_infile_proteins():
+def get_infile_proteins(infile):
     """Parses infile proteins.
 
     returns: dict {prot_name:seq}"""
     infile_proteins = {}
-    for record in SeqIO.parse(infile, 'fasta'):
-        infile_proteins[record.id] = str(record.seq)
+    for name, seq in parse_fasta(infile):
+        infile_proteins[name] = seq
     return infile_proteins
 
 
-def get_candidates(threads, max_hits, queries):
+# proteins of the current sample {prot_name: seq}, set in worker
+# processes by init_candidates_worker
+sample_proteins = None
+
+
+def init_candidates_worker(infile_proteins):
+    """Sets sample proteins of a worker process, so they are sent once
+    per worker and not with every task."""
+    global sample_proteins
+    sample_proteins = infile_proteins
+
+
+def init_new_best_hits_worker(args_, dfo_, tax_group_, input_taxonomy_, reciprocal_hits_):
+    """Sets globals used by new_best_hits in a worker process. Workers
+    started by spawn (macOS, Windows) do not inherit globals set in
+    __main__ at all."""
+    global args, dfo, tax_group, input_taxonomy, reciprocal_hits
+    args, dfo, tax_group = args_, dfo_, tax_group_
+    input_taxonomy, reciprocal_hits = input_taxonomy_, reciprocal_hits_
+
+
+def get_candidates(threads, max_hits, queries, infile_proteins):
     """pararellized best_hits function
     return list of tuples (gene:[candidate names],..)"""
-    with Pool(processes=threads) as pool:
+    queries = list(queries)
+    chunksize = max(1, len(queries) // (4 * threads))
+    # next sample is prepared in a background thread meanwhile, forking
+    # a multi-threaded process can deadlock
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=threads, mp_context=multiprocessing.get_context(start_method),
+                             initializer=init_candidates_worker, initargs=(infile_proteins,)) as executor:
         func = partial(best_hits, max_hits)
-        candidates = list(pool.map(func, queries))
+        candidates = list(executor.map(func, queries, chunksize=chunksize))
         return candidates
 
 
-def get_hmm_profiles():
+@lru_cache(maxsize=1)
+def get_hmm_profiles(database):
     """Parses gene names.
 
-    Returns: list with gene names"""
-    hmm_profiles = []
-    for file in os.listdir(str(Path(dfo, 'profiles/'))):
-        hmm_profiles.append(file.split('.')[0])
-    return hmm_profiles
+    Returns: tuple with gene names"""
+    with os.scandir(Path(database, 'profiles')) as entries:
+        return tuple(entry.name[:-4] for entry in entries if entry.name.endswith('.hmm'))
+
+
+def concat_hmm_profiles():
+    """Concatenates hmm profiles of all genes into one file, so every
+    sample is searched by a single hmmsearch run.
+
+    returns: tuple with path to the concatenated profiles
+    and {hmm name: gene} dict"""
+    hmm_file = f'{args.output}/tmp/profiles.hmm'
+    names = {}
+    with open(hmm_file, 'w') as res:
+        for query in profiles:
+            for line_ in open(str(Path(dfo, f'profiles/{query}.hmm'))):
+                if line_.startswith('NAME '):
+                    names[line_.split()[1]] = query
+                res.write(line_)
+    return hmm_file, names
 
 
 def makedirs():
@@ -292,23 +395,42 @@ def makedirs():
             os.mkdir(directory)
 
 
-def phylofisher(threads, max_hits, spec_queries=None):
-    infile_proteins = get_infile_proteins()
+def prepare_sample(fasta_file, sample_name, spec_queries=None):
+    """Steps of a sample which do not depend on other samples: cd-hit,
+    renaming and diamond db (when spec queries are used). Runs in
+    a background thread while the previous sample is searched.
+
+    returns: abs path to the file with clustered and renamed sequences"""
+    os.mkdir(f'{args.output}/tmp/{sample_name}')
+    # performs cd-hit and rename sequences to common format
+    # shortName_number
+    infile = cluster_rename_sequences(fasta_file, sample_name)
+    if spec_queries:
+        # makes diamond db from input proteins
+        makediamonddb(infile, sample_name)
+    return infile
+
+
+def phylofisher(threads, max_hits, infile, sample_name, diamond_fp, spec_queries=None):
+    infile_proteins = get_infile_proteins(infile)
     if spec_queries:
-        # makes blastdb from input proteins
-        makeblastdb()
-        gene_dict = get_gene_dict(threads, infile_proteins, spec_queries)
+        gene_dict = get_gene_dict(threads, infile, sample_name, spec_queries)
+        # one diamond search with seeds of all genes
+        batch_spec_query_blast(gene_dict.values(), sample_name)
     else:
-        gene_dict = get_gene_dict(threads, infile_proteins)
+        gene_dict = get_gene_dict(threads, infile, sample_name)
 
     # return list of tuples (gene:[candidate names],..)
-    candidates = get_candidates(threads, max_hits, gene_dict.values())
-    # writes all candidates to for_diamond.fasta"
-    with open(f'{args.output}/tmp/for_diamond.fasta', 'a') as f:
-        for gene, candi_list in candidates:
-            if candi_list:
-                for hit in candi_list:
-                    f.write(f'>{hit.name}_{hit.path_}@{gene}\n{hit.seq}\n')
+    candidates = get_candidates(threads, max_hits, gene_dict.values(), infile_proteins)
+    # writes all candidates to for_diamond.fasta (diamond_fp)
+    sample_candidates = []
+    for gene, candi_list in candidates:
+        if candi_list:
+            for hit in candi_list:
+                full_name = f'{hit.name}_{hit.path_}@{gene}'
+                diamond_fp.write(b'>%s\n%s\n' % (full_name.encode(), hit.seq.encode()))
+                sample_candidates.append((full_name, hit.seq))
+    return sample_candidates
 
 
 def taxonomy_dict():
@@ -323,7 +445,7 @@ def taxonomy_dict():
     return tax_g
 
 
-def cluster_rename_sequences():
+def cluster_rename_sequences(fasta_file, sample_name):
     """Clusters sequences in input fasta file for given organism
     and rename every sequence with shortname_number
 
@@ -336,10 +458,10 @@ def cluster_rename_sequences():
     n = 1
     # prepares files with clustered and renamed sequences
     with open(f'{args.output}/tmp/{sample_name}/clustered_renamed.fasta', 'w') as res:
-        for record in SeqIO.parse(clustered, 'fasta'):
+        for name, seq in parse_fasta(clustered):
             new_name = f"{sample_name}_{n}"
-            original_names[new_name] = record.name
-            res.write(f'>{new_name}\n{record.seq}\n')
+            original_names[new_name] = name
+            res.write(f'>{new_name}\n{seq}\n')
             n += 1
     abs_path = os.path.abspath(f'{args.output}/tmp/{sample_name}/clustered_renamed.fasta')
 
@@ -425,16 +547,28 @@ def diamond():
     run_bash(cmd2)
 
 
+def add_leaf_groups(tree):
+    """Stores taxonomical groups of all leaves under every node
+    as node.groups (single postorder traversal)."""
+    for node in tree.traverse('postorder'):
+        if node.is_leaf():
+            node.groups = {tax_group[node.name]} if node.name in tax_group else set()
+        else:
+            node.groups = set()
+            for child in node.children:
+                node.groups |= child.groups
+
+
 def correct_phylo_group(parent, sample_taxomomy):
-    groups = set()
-    for org in parent.get_leaf_names():
-        if org in tax_group:
-            groups.add(tax_group[org])
-    if len(groups) > 2:
-        return False
-    elif sample_taxomomy in groups:
-        return True
-    return correct_phylo_group(parent.up, sample_taxomomy)
+    """Walks up from parent until a node with the sample taxonomy
+    or with more than two groups is found. Requires add_leaf_groups."""
+    while parent is not None:
+        if len(parent.groups) > 2:
+            return False
+        elif sample_taxomomy in parent.groups:
+            return True
+        parent = parent.up
+    return False
 
 
 def fasttree(checked_hits):
@@ -443,20 +577,20 @@ def fasttree(checked_hits):
     gene = full_name.split('@')[1]
     fas = f'{args.output}/tmp/{org}/{gene}.fas'
     aln = f'{args.output}/tmp/{org}/{gene}.aln'
-    trim = f'{args.output}/tmp/{org}/{gene}.trimal'
     tree_file = f'{args.output}/tmp/{org}/{gene}.tree'
     copyfile(str(Path(dfo, f'orthologs/{gene}.fas')), f'{args.output}/tmp/{org}/{gene}.fas')
     with open(fas, 'a') as f:
         for hit in checked_hits:
             f.write(f'>{hit.name}\n{hit.seq}\n')
-    cmd1 = f'mafft --auto --reorder {fas} > {aln}'
-    run_bash(cmd1)
-    cmd2 = f"trimal -in {aln} -gt 0.2 -out {trim}"
-    run_bash(cmd2)
-    cmd3 = f"fasttree {trim} > {tree_file}"
-    run_bash(cmd3)
+    with open(aln, 'w') as aln_file:
+        run_bash(['mafft', '--auto', '--reorder', fas], stdout=aln_file)
+    # trimmed alignment is kept in memory and piped to fasttree
+    trim = run_bash(['trimal', '-in', aln, '-gt', '0.2'])
+    with open(tree_file, 'w') as tree_out:
+        run_bash(['fasttree'], stdout=tree_out, input_=trim)
     tree = Tree(tree_file)
-    correct_len = length_check(trim)
+    add_leaf_groups(tree)
+    correct_len = length_check(trim.decode())
     good_hits = []  # SBH hits
     good_hits_names = set()
     bb_hits = []  # all hits
@@ -464,12 +598,9 @@ def fasttree(checked_hits):
         if hit.name in correct_len:
             bb_hits.append(hit)
             hit_node = tree.search_nodes(name=hit.name)[0]
-            try:
-                if correct_phylo_group(hit_node.up, input_taxonomy[org]) is True:
-                    good_hits.append(hit)
-                    good_hits_names.add(hit.name)
-            except AttributeError:
-                pass
+            if correct_phylo_group(hit_node.up, input_taxonomy[org]) is True:
+                good_hits.append(hit)
+                good_hits_names.add(hit.name)
 
     if args.all_bbh:
         # keep all hits, even if SBH (good hits) hits exist
@@ -489,25 +620,32 @@ def fasttree(checked_hits):
         return []
 
 
+def read_diamond_res(diamond_res):
+    """Reads qseqid and stitle columns of a diamond output.
+
+    returns: pandas DataFrame with full_name and stitle columns"""
+    try:
+        return pd.read_csv(diamond_res, sep='\t', header=None, usecols=[0, 1], names=['full_name', 'stitle'],
+                           dtype=str, quoting=csv.QUOTE_NONE)
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=['full_name', 'stitle'], dtype=str)
+
+
 def parse_diamond_output():
     """checks if best hit from database is not bacterial or
     from wrong orthogroups
 
     returns: names of filtered hits with info about gene"""
-    correct_hits = set()
-    proccesed = set()
-    for line in open(f'{args.output}/tmp/orthomcl_diamond.res'):
-        sline = line.split("\t")
-        full_name = sline[0]
-        hit, gene = full_name.split('@')
-        if full_name not in proccesed:
-            proccesed.add(full_name)
-            org = sline[1].split('|')[0]
-            org = sline[1].split('|')[0]
-            og = sline[1].split('|')[2].strip()
-            if org not in bacterial and og in gene_og[gene]:
-                correct_hits.add(full_name)
-    return correct_hits
+    df = read_diamond_res(f'{args.output}/tmp/orthomcl_diamond.res')
+    # best hit is the first one
+    df = df.drop_duplicates('full_name', keep='first')
+    gene = df['full_name'].str.split('@', n=1).str[1]
+    stitle = df['stitle'].str.split('|')
+    org = stitle.str[0]
+    og = stitle.str[2].str.strip()
+    correct_og = pd.Series([og_ in gene_og.get(gene_, ()) for gene_, og_ in zip(gene, og)],
+                           index=df.index, dtype=bool)
+    return set(df.loc[~org.isin(bacterial) & correct_og, 'full_name'])
 
 
 def new_best_hits(candidate_hits):
@@ -530,43 +668,45 @@ def new_best_hits(candidate_hits):
         if not os.path.isfile(dataset):
             copyfile(str(Path(dfo, f'orthologs/{gene}.fas')), dataset)
         n = 0
-        for cand in top_candidates:
-            n += 1
-            with open(dataset, 'a') as d:
-                seq_name = cand.name.split("@")[0]
-                gene = cand.name.split("@")[1]
-                # TODO: is this exception handling just for debugging?
-                try:
-                    # if hit is reciprocal hit to a corresponding gene
-                    if gene == reciprocal_hits[seq_name[:-4]]:
-                        d.write(f'>{seq_name}_q{n}c\n{cand.seq}\n')
-                    else:
-                        d.write(f'>{seq_name}_q{n}n\n{cand.seq}\n')
-                        with open(f'{args.output}/non_corresponding_hits.txt', 'a') as nonrep:
-                            nonrep.write(
-                                f'non-corresponding hit:{cand.name}; Best hit from:{reciprocal_hits[seq_name[:-4]]}\n')
-                            print(f'non-corresponding hit:{cand.name}; Best hit from: {reciprocal_hits[seq_name[:-4]]}')
-                except KeyError:
-                    n -= 1
+        non_corresponding = []
+        with open(dataset, 'a') as d:
+            for cand in top_candidates:
+                seq_name, gene = cand.name.split("@")
+                best_hit_from = reciprocal_hits.get(seq_name[:-4])
+                if best_hit_from is None:
+                    continue
+                n += 1
+                # if hit is reciprocal hit to a corresponding gene
+                if gene == best_hit_from:
+                    d.write(f'>{seq_name}_q{n}c\n{cand.seq}\n')
+                else:
+                    d.write(f'>{seq_name}_q{n}n\n{cand.seq}\n')
+                    non_corresponding.append(f'non-corresponding hit:{cand.name}; Best hit from:{best_hit_from}\n')
+                    print(f'non-corresponding hit:{cand.name}; Best hit from: {best_hit_from}')
+        if non_corresponding:
+            with open(f'{args.output}/non_corresponding_hits.txt', 'a') as nonrep:
+                nonrep.write(''.join(non_corresponding))
 
 
 def parallel_new_best_hits(gene_hits):
     """Just pararallel run of new_best_candidates """
-    with Pool(processes=int(args.threads)) as pool:
+    worker_globals = (args, dfo, tax_group, input_taxonomy, reciprocal_hits)
+    with Pool(processes=int(args.threads), initializer=init_new_best_hits_worker,
+              initargs=worker_globals) as pool:
         pool.map(new_best_hits, gene_hits)
 
 
-def prepare_good_hits():
+def prepare_good_hits(all_candidates):
     """Prepares all hits for filtration. It filters everything which is
     not in correct hits (wrongs orthogroups or bacterial best diamond
     hit from orthomcl database)"""
     gene_hits = defaultdict(list)
-    for record in SeqIO.parse(f'{args.output}/tmp/for_diamond.fasta', 'fasta'):
-        if record.name in correct_hits:
-            gene = record.name.split('@')[1]
-            org = record.name.split('_')[0]
+    for name, seq in all_candidates:
+        if name in correct_hits:
+            gene = name.split('@')[1]
+            org = name.split('_')[0]
             org_gene = f'{org}_{gene}'
-            gene_hits[org_gene].append(record)
+            gene_hits[org_gene].append(Hit(name, seq, gene, set()))
     parallel_new_best_hits(list(gene_hits.values()))
 
 
@@ -574,18 +714,11 @@ def get_reciprocal_hits():
     """Checks if candidate is reciprocal best blast hit with gene
 
     returns: list with reciprocal hits"""
-    reciprocal = {}
-    proccesed = set()
-    for line in open(f'{args.output}/tmp/dataset_diamond.res'):
-        sline = line.split("\t")
-        full_name = sline[0]
-        sequence, gene = full_name.split('@')  # do we need this line??
-        sequence = sequence[:-4]
-        if sequence not in proccesed:
-            proccesed.add(sequence)
-            hit_gene = sline[1]
-            reciprocal[sequence] = hit_gene
-    return reciprocal
+    df = read_diamond_res(f'{args.output}/tmp/dataset_diamond.res')
+    # strips _SBH/_HMM and gene from the full name
+    df['sequence'] = df['full_name'].str.split('@', n=1).str[0].str[:-4]
+    df = df.drop_duplicates('sequence', keep='first')
+    return dict(zip(df['sequence'], df['stitle']))
 
 
 def additions_to_input():
@@ -664,7 +797,7 @@ if __name__ == '__main__':
     bacterial, gene_og = bac_gog_db()
 
     # returns list with gene names
-    profiles = get_hmm_profiles()
+    profiles = get_hmm_profiles(dfo)
 
     if not args.add:
         # creates output dictionaries tmp and fasta
@@ -683,8 +816,15 @@ if __name__ == '__main__':
         else:
             os.mkdir(f'{args.output}/tmp')
 
+    # all profiles in one file for hmmsearch
+    hmm_db, hmm_names = concat_hmm_profiles()
+
     # stores information about org:taxonomy for input samples
     input_taxonomy = {}
+    # (fasta file, sample name, specific queries) for input samples
+    samples = []
+    # (full name, seq) of all candidates written to for_diamond.fasta
+    all_candidates = []
 
     for line in open(input_metadata):
         if "File Name" not in line:  # TODO fix me
@@ -695,22 +835,28 @@ if __name__ == '__main__':
             taxonomy = metadata_input[3].strip()
             input_taxonomy[sample_name] = taxonomy
             specific_queries = metadata_input[5].strip()
-            print(f'{sample_name} has started\n--------------------------')
-            os.mkdir(f'{args.output}/tmp/{sample_name}')
-
-            # performs cd-hit and rename sequences to common format
-            # shortName_number
-            infile = cluster_rename_sequences()
 
             # parses specifiq queries
-            specific_queries = specific_queries.strip()
             if specific_queries.lower() == 'none':
                 specific_queries = None
+            samples.append((fasta_file, sample_name, specific_queries))
+
+    # cd-hit (and diamond db) of the next sample runs in the background
+    # while the current sample is searched
+    with ThreadPoolExecutor(max_workers=1) as executor, \
+            open(f'{args.output}/tmp/for_diamond.fasta', 'ab', buffering=4 << 20) as diamond_fp:
+        if samples:
+            prepared = executor.submit(prepare_sample, *samples[0])
+        for i, (_, sample_name, specific_queries) in enumerate(samples):
+            infile = prepared.result()
+            if i + 1 < len(samples):
+                prepared = executor.submit(prepare_sample, *samples[i + 1])
+            print(f'{sample_name} has started\n--------------------------')
 
             # prepares candidates for all genes (according to blast and/or hmmsearch)
             # and stores them in for_diamond.fasta
-            phylofisher(args.threads,
-                        args.max_hits, specific_queries)
+            all_candidates += phylofisher(args.threads, args.max_hits,
+                                          infile, sample_name, diamond_fp, specific_queries)
 
     # performs diamond search against orthomcl database
     diamond()
@@ -721,7 +867,7 @@ if __name__ == '__main__':
     # returns hits which are reciprocal with gene from datasetdb
     reciprocal_hits = get_reciprocal_hits()
     # final function
-    prepare_good_hits()
+    prepare_good_hits(all_candidates)
 
     if args.add:
         # adds additional input metadata to original input metadata
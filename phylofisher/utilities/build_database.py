@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 import csv
 import os
-import random
+import re
+import shlex
 import shutil
 import string
 import subprocess
 import sys
+import tempfile
 import textwrap
-from collections import defaultdict, Counter
-from glob import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from random import choices
 import matplotlib.colors as mcolors
 import pandas as pd
 from Bio import SeqIO
@@ -35,8 +37,30 @@ def csv_to_tsv():
         shutil.move('tmp', tsv)
 
 
-def rename_taxa():
-    """"""
+def list_fasta_files(directory):
+    """
+    Returns paths of all .fas files in directory
+
+    :param directory: directory with fasta files (orthologs, paralogs)
+    :return: list of paths
+    """
+    if not os.path.isdir(directory):
+        return []
+    with os.scandir(directory) as entries:
+        return [entry.path for entry in entries
+                if entry.name.endswith('.fas') and not entry.name.startswith('.')
+                and entry.is_file()]
+
+
+def rename_taxa(metadata, ortholog_files):
+    """
+    Renames taxa from to_rename.tsv (args.rename) in orthologs, paralogs
+    and metadata.
+
+    :param metadata: metadata DataFrame, updated in place
+    :param ortholog_files: fasta files in orthologs dir
+    :return: None
+    """
 
 
     # Read in to_rename.tsv
@@ -49,46 +73,61 @@ def rename_taxa():
             rename_dict[line_list[0]] = line_list[1:]
 
     # Rename in orthologs/ and paralogs/
-    files = glob('orthologs/*.fas') + glob('paralogs/*.fas')
-    for file in files:
-        with open(file, 'r') as infile, open('tmp', 'w') as tmp_file:
-            for line in infile:
-                line = line.strip()
-                for key, value in rename_dict.items():
-                    if key in line:
-                        line = line.replace(key, value[0])
-                tmp_file.write(f'{line}\n')
-        shutil.move('tmp', file)
-
-    df = pd.read_csv('metadata.tsv', sep='\t')
-    for key, value in rename_dict.items():
-        df.loc[df['Unique ID'] == key, 'Long Name'] = value[1]
-        df.loc[df['Unique ID'] == key, 'Unique ID'] = value[0]
+    # all old IDs in one pattern, longest first so that no ID is
+    # replaced by a shorter one which is its prefix
+    id_map = {key: value[0] for key, value in rename_dict.items()}
+    byte_map = {key.encode(): value.encode() for key, value in id_map.items()}
+    pattern = re.compile(b'|'.join(re.escape(key) for key in sorted(byte_map, key=len, reverse=True)))
+    files = ortholog_files + list_fasta_files('paralogs')
+    for file in files if byte_map else []:
+        with open(file, 'rb') as infile, open('tmp', 'wb') as tmp_file:
+            tmp_file.write(pattern.sub(lambda match: byte_map[match.group(0)], infile.read()))
+        os.replace('tmp', file)
+
+    df = metadata
+    long_name_map = {key: value[1] for key, value in rename_dict.items()}
+    to_rename = df['Unique ID'].isin(id_map)
+    df.loc[to_rename, 'Long Name'] = df.loc[to_rename, 'Unique ID'].map(long_name_map)
+    df.loc[to_rename, 'Unique ID'] = df.loc[to_rename, 'Unique ID'].map(id_map)
     
     df.to_csv('metadata.tsv', sep='\t', index=False)
 
 
-def get_ortho_taxa():
+def scan_headers(file):
+    """
+    Returns set of headers (without >) in a fasta file
+    """
+    headers = set()
+    with open(file, 'r', buffering=1 << 20) as infile:
+        for line in infile:
+            if line.startswith('>'):
+                headers.add(line[1:].rstrip())
+
+    return headers
+
+
+def get_ortho_taxa(threads, ortholog_files):
     """
     Returns unique set of taxa in orthologs dir
+
+    :param threads: number of processes scanning the files
+    :param ortholog_files: fasta files in orthologs dir
     """
     unique_orgs_orthos = set()
-    files = glob('orthologs/*.fas')
-    for file in files:
-        with open(file, 'r') as infile:
-            records = SeqIO.parse(infile, 'fasta')
-            for record in records:
-                unique_orgs_orthos.add(record.description)
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        for headers in executor.map(scan_headers, ortholog_files, chunksize=16):
+            unique_orgs_orthos |= headers
 
     return unique_orgs_orthos
 
 
-def check_orthologs():
+def check_orthologs(ortholog_files):
     """
     Check that IDs in orthologs are all unique in the file.
+
+    :param ortholog_files: fasta files in orthologs dir
     """
-    files = glob('orthologs/*.fas')
-    for file in files:
+    for file in ortholog_files:
         ids = set()
         with open(file, 'r') as infile:
             records = SeqIO.parse(infile, 'fasta')
@@ -99,53 +138,64 @@ def check_orthologs():
                 ids.add(record.name)
 
 
-def get_meta_taxa():
+def read_metadata(metadata):
+    """
+    Parses metadata (all columns as strings). Parsed once per run
+    and shared by check_taxa and rename_taxa.
+
+    :param metadata: path to metadata.tsv
+    :return: pandas DataFrame
+    """
+    return pd.read_csv(metadata, sep='\t', dtype=str, keep_default_na=False)
+
+
+def get_meta_taxa(metadata):
     """
     Returns unique set of taxa in metadata
+
+    :param metadata: metadata DataFrame
     """
     unique_orgs_meta = set()
-    with open('metadata.tsv', 'r') as csvfile:
-        reader = csv.reader(csvfile, delimiter='\t')
-        for row in reader:
-            id_ = row[0]
-            if id_ == 'Unique ID':
-                continue
-            
-            #check that ID is unique
-            if id_ in unique_orgs_meta:
-                print("ERROR: ", id_, "is not a unique ID")
+    for id_ in metadata['Unique ID']:
+        #check that ID is unique
+        if id_ in unique_orgs_meta:
+            print("ERROR: ", id_, "is not a unique ID")
+            sys.exit()
+
+        #check illegal characters
+        for ch in ["_", '@', '..', '*', ' ']:
+            if ch in id_:
+                print(f"ERROR: illegal character {ch} in {id_}")
                 sys.exit()
 
-            #check illegal characters
-            for ch in ["_", '@', '..', '*', ' ']:
-                if ch in id_:
-                    print(f"ERROR: illegal character {ch} in {id_}")
-                    sys.exit()
-
-            unique_orgs_meta.add(id_)
+        unique_orgs_meta.add(id_)
     return unique_orgs_meta
 
 
-def check_taxa():
+def check_taxa(threads, metadata, ortholog_files):
     """
     Checks to see if all taxa in metadata is in ortholog dir and vice-versa. If there are differences the script exits
     here and prints the discrepancies.
 
+    :param threads: number of threads
+    :param metadata: metadata DataFrame
+    :param ortholog_files: fasta files in orthologs dir
     :return: None
     """
-    unique_orgs_orthos = get_ortho_taxa()
-    unique_orgs_meta = get_meta_taxa()
+    unique_orgs_orthos = get_ortho_taxa(threads, ortholog_files)
+    unique_orgs_meta = get_meta_taxa(metadata)
+
+    only_meta = unique_orgs_meta - unique_orgs_orthos
+    only_orthos = unique_orgs_orthos - unique_orgs_meta
 
     # Exits if there are differences and prints those differences
-    if len(unique_orgs_meta - unique_orgs_orthos) > 0 or len(unique_orgs_orthos - unique_orgs_meta) > 0:
-        if len(unique_orgs_meta - unique_orgs_orthos) > 0:
-            print(f'Taxa in metadata but not in orthologs dir:')
-            for org in (unique_orgs_meta - unique_orgs_orthos):
-                print(org)
-        if len(unique_orgs_orthos - unique_orgs_meta) > 0:
-            print(f'Taxa in orthlog dir but not in metadata:')
-            for org in (unique_orgs_orthos - unique_orgs_meta):
-                print(org)
+    if only_meta or only_orthos:
+        if only_meta:
+            print('Taxa in metadata but not in orthologs dir:')
+            print('\n'.join(sorted(only_meta)))
+        if only_orthos:
+            print('Taxa in orthlog dir but not in metadata:')
+            print('\n'.join(sorted(only_orthos)))
         sys.exit()
 
 
@@ -156,85 +206,159 @@ def id_generator(size=5, chars=string.digits):
     :param chars:
     :return:
     """
-    return ''.join(random.choice(chars) for _ in range(size))
+    return ''.join(choices(chars, k=size))
 
 
 def paralog_name(abbrev, keys):
     """"Prepare paralog name (short name + 5 random digits).
-    Recursive function.
     example: Homosap..12345
     input: short name of an organism, names of already existing paralogs
-    for a given organism
+    for a given organism (set or dict keys)
     return: unique paralog name"""
-    id_ = id_generator()
-    pname = f'{abbrev}..p{id_}'
-    if pname not in keys:
-        return pname
-    else:
-        paralog_name(abbrev, keys)
+    while True:
+        pname = f'{abbrev}..p{id_generator()}'
+        if pname not in keys:
+            return pname
 
 
-def prepare_diamond_input():
+# fasta header without '>' and trailing whitespace
+FASTA_HEADER = re.compile(rb'^>([^\n]*?)[ \t\r\f\v]*\n', re.M)
+# gaps and whitespace (except newlines) removed from sequence lines
+SEQ_DELETE = b'- \t\r\f\v'
+
+
+def add_gene_to_headers(file, out_file):
+    """
+    Writes sequences of an ortholog file to out_file with the gene
+    before every sequence name (ADK2@Allomacr). Gaps are removed
+    from sequences.
+
+    :param file: fasta file from orthologs dir
+    :param out_file: output fasta file
+    :return: None
+    """
+    gene = file.split('/')[-1].split('.')[0].encode()
+    with open(file, 'rb') as infile:
+        data = infile.read()
+    if data and not data.endswith(b'\n'):
+        data += b'\n'
+
+    # [before first header, name, sequence lines, name, sequence lines, ...]
+    parts = FASTA_HEADER.split(data)
+    res = [parts[0].translate(None, SEQ_DELETE)]
+    for name, seq in zip(parts[1::2], parts[2::2]):
+        res.append(b'>%s@%s\n' % (gene, name))
+        res.append(seq.translate(None, SEQ_DELETE))
+    with open(out_file, 'wb') as outfile:
+        outfile.write(b''.join(res))
+
+
+def prepare_diamond_input(threads, ortholog_files):
     """
     Prepares seqs for diamond in a way that it connects
     information about gene before sequence name.
     Example: Allomacr from ADK2.fas will be named
     ADK2@Allomacr at the for_diamond.fasta file.
 
+    :param threads: number of processes rewriting the files
+    :param ortholog_files: fasta files in orthologs dir
     :return: None
     """
-    files = glob('orthologs/*.fas')
-    with open("for_diamond.fasta", 'w') as res:
-        for file in files:
-            gene = file.split('/')[-1].split('.')[0]
-            for record in SeqIO.parse(file, 'fasta'):
-                res.write(f'>{gene}@{record.description}\n{record.seq}\n')
-
+    with tempfile.TemporaryDirectory(dir='.') as tmp_dir:
+        # every file is rewritten to its own part, parts are concatenated in order
+        parts = [os.path.join(tmp_dir, f'for_diamond.{i}.fasta') for i in range(len(ortholog_files))]
+        with ProcessPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(add_gene_to_headers, ortholog_files, parts, chunksize=16))
+
+        with open("for_diamond.fasta", 'wb', buffering=16 << 20) as res:
+            # reserve the whole file at once so it is laid out contiguously
+            # for diamond's sequential read
+            if hasattr(os, 'posix_fallocate'):
+                size = sum(os.path.getsize(part) for part in parts)
+                if size:
+                    try:
+                        os.posix_fallocate(res.fileno(), 0, size)
+                    except OSError:
+                        pass
+            for part in parts:
+                with open(part, 'rb') as infile:
+                    shutil.copyfileobj(infile, res, 16 << 20)
+
+
+def diamond_block_size():
+    """
+    Diamond block size (-b, billions of sequence letters) derived from
+    available memory (MemAvailable). Diamond uses roughly 6 GB per unit
+    of block size with its default index chunks. Never below diamond's
+    default of 2.0.
 
-def diamond():
+    :return: block size
+    """
+    try:
+        with open('/proc/meminfo') as infile:
+            for line in infile:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+            else:
+                return 2.0
+    except OSError:
+        # not available (e.g. macOS): diamond's default
+        return 2.0
+    return max(2.0, round(available / 1024 ** 3 / 6, 1))
+
+
+def diamond(threads, sensitivity):
     """
     Uses for_diamond.fasta to diamond orthomcl.diamonddb
 
+    :param threads: number of threads
+    :param sensitivity: diamond sensitivity mode (fast, sensitive, ...)
     :return: None
     """
-    with open('for_diamond.fasta', 'r') as infile, open('new.fas', 'w') as outfile:
-        for line in infile:
-            line = line.strip()
-            if line.startswith(">") is False:
-                line = line.replace('-', '')
-            outfile.write(f'{line}\n')
-
-    shutil.move('new.fas', 'for_diamond.fasta')
-
     db = 'orthomcl/orthomcl.diamonddb.dmnd'
     out = 'diamond.res'
+    # diamond reads the query from its own descriptor, so the query is
+    # only announced here to start read-ahead into the page cache
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open('for_diamond.fasta', os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
     cmd = (
-        f'diamond blastp -e 1e-10 -q for_diamond.fasta --more-sensitive '
-        f'--db {db} -o {out} -p {args.threads} --outfmt 6 qseqid stitle evalue')
+        f'diamond blastp -e 1e-10 -q for_diamond.fasta --{sensitivity} -b {diamond_block_size()} '
+        f'--db {db} -o {out} -p {threads} --outfmt 6 qseqid stitle evalue --quiet')
     subprocess.run(cmd, shell=True)
 
 
 def parse_diamond_output():
-    gene_ogs = defaultdict(list)
-    for line in open('diamond.res'):
-        sline = line.split("\t")
-        full_name = sline[0]  # ADK2@Allomacr
-        gene, _ = full_name.split('@')  # gene: ADK2
-        og = sline[1].split('|')[2].strip()  # parse og name OG5_128398
-        gene_ogs[gene].append(og)  # gene_ogs['ADK2'].append(og)
-    return gene_ogs
+    """
+    Parses gene and orthogroup of every hit in diamond.res.
+
+    :return: pandas DataFrame with gene and og columns
+    """
+    try:
+        df = pd.read_csv('diamond.res', sep='\t', header=None, names=['qseqid', 'stitle', 'evalue'],
+                         usecols=['qseqid', 'stitle'], dtype=str, quoting=csv.QUOTE_NONE, engine='c')
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=['gene', 'og'], dtype=str)
+    gene = df['qseqid'].str.split('@', n=1).str[0]  # ADK2@Allomacr -> ADK2
+    og = df['stitle'].str.split('|').str[2].str.strip()  # parse og name OG5_128398
+    return pd.DataFrame({'gene': gene, 'og': og})
 
 
-def genes_in_orthodb():
+def genes_in_orthodb(ortholog_files):
     """
     Check if gene has an og in orthomcl. If not -> report this gene.
+
+    :param ortholog_files: fasta files in orthologs dir
     """
     gene_in_gene_og = set()
     for line in open("orthomcl/gene_og"):
         gene_in_gene_og.add(line.split()[0])
 
-    files = glob('orthologs/*.fas')
-    genes = [file.split('/')[-1].split('.')[0] for file in files]
+    genes = [file.split('/')[-1].split('.')[0] for file in ortholog_files]
     rerun = False
     for gene in genes:
         if gene not in gene_in_gene_og:
@@ -245,73 +369,77 @@ def genes_in_orthodb():
         sys.exit()
 
 
-def get_og_file(threshold):
-    prepare_diamond_input()  # prepares orthologs for diamondF
-    diamond()  # starts diamond
-    gene_filtered_ogs = defaultdict(list)
+def get_og_file(threshold, threads, sensitivity, ortholog_files):
+    prepare_diamond_input(threads, ortholog_files)  # prepares orthologs for diamondF
+    diamond(threads, sensitivity)  # starts diamond
     gene_ogs = parse_diamond_output()
-    for gene, ogs in gene_ogs.items():
-        total = len(ogs)
-        counted = dict(Counter(ogs))
-        for og, count in counted.items():
-            if count / total >= threshold:
-                gene_filtered_ogs[gene].append(og)
-    with open('orthomcl/gene_og', 'w') as res:
-        for gene, ogs in gene_filtered_ogs.items():
-            res.write(f'{gene}\t{",".join(ogs)}\n')
+    # proportion of hits of every gene in every og
+    fractions = gene_ogs.groupby(['gene', 'og'], sort=False).size().div(
+        gene_ogs.groupby('gene', sort=False).size(), level='gene')
+    filtered = fractions[fractions >= threshold]
+    gene_filtered_ogs = filtered.reset_index().groupby('gene', sort=False)['og'].agg(','.join)
+    gene_filtered_ogs.to_csv('orthomcl/gene_og', sep='\t', header=False)
     os.remove('diamond.res')
     os.remove('for_diamond.fasta')
 
 
-def concat_gene_files():
-    files = glob('*.fas')
+def concat_gene_files(gene_dir, out_file):
+    """
+    Concatenates all fasta files in gene_dir to out_file,
+    every header is replaced by the gene name (file name up to the first dot).
 
-    with open('datasetdb.fasta', 'w') as outfile:
-        for file in files:
-            with open(file, 'r') as infile:
-                for line in infile:
-                    line = line.strip()
-                    if line.startswith('>'):
-                        line = f'>{file.split(".")[0]}'
-                    outfile.write(f'{line}\n')
+    :param gene_dir: directory with gene fasta files
+    :param out_file: concatenated fasta file
+    :return: None
+    """
+    cmd = ("awk 'FNR == 1 {gene = FILENAME; sub(/\\..*/, \"\", gene)} "
+           "/^>/ {print \">\" gene; next} {sub(/^[ \\t\\r]+/, \"\"); sub(/[ \\t\\r]+$/, \"\"); print}' "
+           f"*.fas > {shlex.quote(os.path.abspath(out_file))}")
+    subprocess.run(cmd, shell=True, cwd=gene_dir)
 
 
 def datasetdb():
-    # TODO fix me
+    """
+    Prepares diamond database (datasetdb/datasetdb.dmnd) from all orthologs
+    with gene names as headers. Does not change the working directory,
+    so it can run next to make_profiles.
+
+    :return: None
+    """
     os.mkdir('datasetdb')
-    os.chdir('orthologs')
-    concat_gene_files()
-    shutil.move('datasetdb.fasta', '../datasetdb')
-    os.chdir('../datasetdb')
-    dmd_db = 'diamond makedb --in datasetdb.fasta -d datasetdb'
-    subprocess.run(dmd_db, shell=True)
-    # os.remove('datasetdb.fasta')
-    os.chdir('..')
+    concat_gene_files('orthologs', 'datasetdb/datasetdb.fasta')
+    dmd_db = 'diamond makedb --in datasetdb.fasta -d datasetdb --threads 1'
+    subprocess.run(dmd_db, shell=True, cwd='datasetdb')
 
 
-def make_profiles(threads):
+def make_profiles(threads, jobs=None):
     """
     Prepares hmm profiles from all fasta files with orthologs
     from orthologs folder.
 
     :param threads: number of threads
+    :param jobs: number of genes processed at once (default: threads)
     :return: None
     """
 
     os.mkdir('profiles')
-    os.chdir('orthologs')
+
+    # genes are independent and run in parallel,
+    # threads are split among concurrently running genes
+    jobs = jobs or threads
+    job_threads = max(1, threads // jobs)
 
     # prepares alignments for all fasta files with orthologs
-    aln = f'for i in $(ls *.fas); do mafft --auto' \
-          f' --thread {threads} --reorder $i > $(basename $i .fas).aln; done'
-    subprocess.run(aln, shell=True)
+    aln = f'printf "%s\\0" *.fas | xargs -0 -n 1 -P {jobs} sh -c \'' \
+          f'mafft --auto --thread {job_threads} --reorder "$1" > "${{1%.fas}}.aln"\' _'
+    subprocess.run(aln, shell=True, cwd='orthologs')
 
     # prepares hmm profiles from alignmets made in prev. step
-    hmm = 'for i in $(ls *.aln); do hmmbuild $(basename $i .aln).hmm $i; done'
-    subprocess.run(hmm, shell=True)
-    subprocess.run('mv *.hmm ../profiles', shell=True)
-    subprocess.run('rm *.aln', shell=True)  # delete alignments
-    os.chdir('..')
+    hmm = f'printf "%s\\0" *.aln | xargs -0 -n 1 -P {jobs} sh -c \'' \
+          f'hmmbuild --cpu {job_threads} "${{1%.aln}}.hmm" "$1" > /dev/null\' _'
+    subprocess.run(hmm, shell=True, cwd='orthologs')
+    subprocess.run('mv *.hmm ../profiles', shell=True, cwd='orthologs')
+    subprocess.run('rm *.aln', shell=True, cwd='orthologs')  # delete alignments
 
 def generate_tree_colors():
 
@@ -327,12 +455,14 @@ def generate_tree_colors():
         for i, higher_tax in enumerate(sorted(list(higher_tax_set))):
             outfile.write(f'{higher_tax}\t{colors[i]}\n')
 
-def main(args, threads, no_og_file, threshold):
+def main(args, threads, no_og_file, threshold, metadata=None, ortholog_files=None):
     """
     :param args:
     :param threads: number of threads
     :param make_og_file: Boolean
     :param threshold: float 0-1
+    :param metadata: metadata DataFrame (read from metadata.tsv if None)
+    :param ortholog_files: fasta files in orthologs dir (listed if None)
     :return: None
     """
 
@@ -345,19 +475,32 @@ def main(args, threads, no_og_file, threshold):
     if os.path.isdir('profiles') is True:
         shutil.rmtree('profiles')
 
+    if ortholog_files is None:
+        ortholog_files = list_fasta_files('orthologs')
+
     if args.rename:
+        if metadata is None:
+            metadata = read_metadata('metadata.tsv')
         tools.backup(os.getcwd())
-        rename_taxa()
+        rename_taxa(metadata, ortholog_files)
         tools.backup(os.getcwd())
 
-    datasetdb()  # creates datasetdb
-
-    make_profiles(threads)
+    if threads > 1:
+        # datasetdb and profiles are built at the same time, both only
+        # read orthologs; diamond makedb gets one thread of the budget
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            dataset_db = executor.submit(datasetdb)  # creates datasetdb
+            profiles = executor.submit(make_profiles, threads - 1)
+            dataset_db.result()
+            profiles.result()
+    else:
+        datasetdb()  # creates datasetdb
+        make_profiles(threads)
 
     if not no_og_file:
-        get_og_file(threshold)
+        get_og_file(threshold, threads, args.sensitivity, ortholog_files)
 
-    genes_in_orthodb()
+    genes_in_orthodb(ortholog_files)
 
 if __name__ == "__main__":
     description = 'Script for database construction and taxonomic updates. Must be run within path/to/database/'
@@ -381,6 +524,14 @@ if __name__ == "__main__":
                           OrthoMCL orthogroup for the group to be assigned.
                           Default: 0.1 (10%%)
                           """))
+    optional.add_argument('--sensitivity', default='fast', metavar='<mode>',
+                          choices=['fast', 'mid-sensitive', 'sensitive', 'more-sensitive', 'very-sensitive',
+                                   'ultra-sensitive'],
+                          help=textwrap.dedent("""\
+                          DIAMOND sensitivity mode used to assign OrthoMCL orthogroups:
+                          fast, mid-sensitive, sensitive, more-sensitive, very-sensitive or ultra-sensitive.
+                          Default: fast
+                          """))
     optional.add_argument('--rename', type=str, metavar='<to_rename.tsv>',
                           help=textwrap.dedent("""\
                           Rename taxa in the database.
@@ -390,9 +541,12 @@ if __name__ == "__main__":
     args = help_formatter.get_args(parser, optional, required, pre_suf=False, inp_dir=False, out_dir=False)
 
     csv_to_tsv()
-    check_orthologs()
-    check_taxa()
-    main(args, args.threads, args.no_og_file, args.og_threshold)
+    # metadata and ortholog files are read once and shared by all steps
+    metadata = read_metadata('metadata.tsv')
+    ortholog_files = list_fasta_files('orthologs')
+    check_orthologs(ortholog_files)
+    check_taxa(args.threads, metadata, ortholog_files)
+    main(args, args.threads, args.no_og_file, args.og_threshold, metadata, ortholog_files)
     
     if not os.path.exists('tree_colors.tsv'):
         generate_tree_colors()
\ No newline at end of file